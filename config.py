@@ -3,7 +3,64 @@ Reads and stores application configuration (tokens, settings, etc.).
 """
 
 import os
-from configparser import ConfigParser
+import re
+from configparser import NoOptionError, NoSectionError
+
+
+# Marker for "no fallback given", so that None can be used as a fallback value
+_UNSET = object()
+
+
+class FastConfigParser:
+    """
+    Minimal INI reader for flat `key = value` files.
+    Supports only what config.ini uses (sections, keys, comment lines),
+    so the whole file is parsed with a couple of regex passes.
+    """
+
+    _section_re = re.compile(r"^\[([^\]]+)\]", re.M)
+    _kv_re = re.compile(r"^[ \t]*([^=;#\s][^=\n]*?)[ \t]*=[ \t]*(.*?)[ \t]*$", re.M)
+
+    def __init__(self, config_path: str):
+        self._sections: dict[str, dict[str, str]] = {}
+
+        # Like ConfigParser.read(), silently ignore a missing file
+        try:
+            with open(config_path, encoding="utf-8") as f:
+                text = f.read()
+        except OSError:
+            return
+
+        headers = list(self._section_re.finditer(text))
+        for i, header in enumerate(headers):
+            end = headers[i + 1].start() if i + 1 < len(headers) else len(text)
+            body = text[header.end():end]
+            # Option names are case-insensitive, as in ConfigParser
+            self._sections[header.group(1).strip()] = {
+                key.lower(): value for key, value in self._kv_re.findall(body)
+            }
+
+    def get(self, section: str, option: str, *, fallback=_UNSET) -> str:
+        try:
+            options = self._sections[section]
+        except KeyError:
+            if fallback is not _UNSET:
+                return fallback
+            raise NoSectionError(section) from None
+        try:
+            return options[option.lower()]
+        except KeyError:
+            if fallback is not _UNSET:
+                return fallback
+            raise NoOptionError(option, section) from None
+
+    def getint(self, section: str, option: str, *, fallback=_UNSET) -> int:
+        value = self.get(section, option, fallback=fallback)
+        return value if value is fallback else int(value)
+
+    def getfloat(self, section: str, option: str, *, fallback=_UNSET) -> float:
+        value = self.get(section, option, fallback=fallback)
+        return value if value is fallback else float(value)
 
 
 class ConfigManager:
@@ -14,8 +71,7 @@ class ConfigManager:
     """
 
     def __init__(self, config_path: str = "config.ini"):
-        self._config = ConfigParser()
-        self._config.read(config_path)
+        self._config = FastConfigParser(config_path)
 
         self.TELEGRAM_TOKEN = self._config.get("tokens", "TELEGRAM_TOKEN")
         self.OPENAI_API_KEY = self._config.get("tokens", "OPENAI_API_KEY")
@@ -27,14 +83,20 @@ class ConfigManager:
         self.LLM_DECISSION_TO_RESPOND_THRESHOLD = self._config.getfloat(
             "settings", "LLM_DECISSION_TO_RESPOND_THRESHOLD"
         )
-        
+
         self.MESSAGE_HISTORY_LIMIT = self._config.getint("settings", "MESSAGE_HISTORY_LIMIT")
+        self.MAX_CONCURRENT_OPENAI = self._config.getint(
+            "settings", "MAX_CONCURRENT_OPENAI", fallback=8
+        )
 
         # Set environment variables if needed
         os.environ["TAVILY_API_KEY"] = self.TAVILY_API_KEY
 
         self.MAIN_WORKFLOW_MODEL = self._config.get("models", "MAIN_WORKFLOW_MODEL")
         self.SHOULD_RESPOND_MODEL = self._config.get("models", "SHOULD_RESPOND_MODEL")
+        self.TRANSCRIPTION_MODEL = self._config.get(
+            "models", "TRANSCRIPTION_MODEL", fallback="gpt-4o-mini-transcribe"
+        )
 
 
 # Create a single shared instance for the entire application
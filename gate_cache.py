@@ -0,0 +1,109 @@
+"""
+Persistent cache of the should-respond decisions, so that they survive a restart.
+"""
+
+import atexit
+import collections
+import sqlite3
+import threading
+import time
+
+from logger_setup import logger
+
+
+class GateCache:
+    """
+    In-memory LRU of should-respond probabilities keyed by a message-window hash,
+    backed by an SQLite table. Entries expire after ENTRY_TTL_SECONDS. New entries
+    are written behind in batches by a background thread instead of one small
+    transaction per decision.
+    """
+
+    FLUSH_INTERVAL_SECONDS = 5
+    FLUSH_BATCH_SIZE = 64
+    ENTRY_TTL_SECONDS = 24 * 60 * 60
+
+    def __init__(self, db_path: str, max_size: int):
+        self._max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._pending = []
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS gate_cache (hash BLOB PRIMARY KEY, prob REAL, ts INTEGER)"
+            )
+            self._conn.execute("DELETE FROM gate_cache WHERE ts < ?", (int(time.time()) - self.ENTRY_TTL_SECONDS,))
+
+        # Load the most recent entries, oldest first so that the LRU order is kept.
+        # Many rows share a timestamp in seconds, the rowid gives the order they were written in.
+        rows = self._conn.execute(
+            "SELECT hash, prob, ts FROM "
+            "(SELECT hash, prob, ts, rowid AS seq FROM gate_cache ORDER BY ts DESC, seq DESC LIMIT ?) "
+            "ORDER BY ts, seq",
+            (max_size,)
+        ).fetchall()
+        self._entries.update((key, (probability, ts)) for key, probability, ts in rows)
+        logger.info("GateCache: Loaded %s cached decisions.", len(self._entries))
+
+        self._flush_requested = threading.Event()
+        threading.Thread(target=self._flush_loop, name="gate-cache-flush", daemon=True).start()
+        # The flush thread is a daemon, write out what is left when the application exits
+        atexit.register(self.flush)
+
+    def get(self, key: bytes) -> float | None:
+        """
+        Returns the cached probability for the key, or None if it is not cached or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            probability, ts = entry
+            if ts < int(time.time()) - self.ENTRY_TTL_SECONDS:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return probability
+
+    def put(self, key: bytes, probability: float):
+        """
+        Caches the probability and queues it to be written to the database.
+        """
+        ts = int(time.time())
+        with self._lock:
+            self._entries[key] = (probability, ts)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+            self._pending.append((key, probability, ts))
+            if len(self._pending) >= self.FLUSH_BATCH_SIZE:
+                self._flush_requested.set()
+
+    def flush(self):
+        """
+        Writes the queued entries in one transaction and drops the expired ones.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        try:
+            with self._conn:
+                self._conn.executemany("INSERT OR REPLACE INTO gate_cache (hash, prob, ts) VALUES (?, ?, ?)", pending)
+                self._conn.execute("DELETE FROM gate_cache WHERE ts < ?", (int(time.time()) - self.ENTRY_TTL_SECONDS,))
+        except sqlite3.Error as e:
+            logger.error("GateCache: Failed to write %s cached decisions: %s", len(pending), e)
+
+    def _flush_loop(self):
+        """
+        Flushes every FLUSH_INTERVAL_SECONDS, or earlier when FLUSH_BATCH_SIZE entries are queued.
+        """
+        while True:
+            self._flush_requested.wait(self.FLUSH_INTERVAL_SECONDS)
+            self._flush_requested.clear()
+            self.flush()
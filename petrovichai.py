@@ -11,7 +11,10 @@ from config import CONFIG
 from workflow_controller import WorkflowController
 from telegram_message_handler import TelegramMessageHandler
 
-BOT_USERNAME = None  # Global variable for storing the bot's username
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
 
 
 class BotApplication:
@@ -41,10 +44,10 @@ class BotApplication:
         """
         Gets the bot's username from Telegram for mention-related logic.
         """
-        global BOT_USERNAME
         me = await self.bot.get_me()
-        BOT_USERNAME = me.username.lower()
-        logger.info(f"BotApplication: BOT_USERNAME set to: {BOT_USERNAME}")
+        bot_username = me.username.lower()
+        self.workflow_controller.bot_username = bot_username
+        logger.info("BotApplication: Bot username set to: %s", bot_username)
 
     def register_handlers(self):
         """
@@ -77,6 +80,10 @@ async def main():
     await app.start()
 
 if __name__ == "__main__":
+    # The bot is I/O-bound, so run it on the faster libuv-based event loop when available
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
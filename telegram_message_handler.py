@@ -2,8 +2,9 @@
 Class that handles incoming Telegram messages. Uses WorkflowController for decisions.
 """
 
-import os
-import base64
+import io
+import asyncio
+import pybase64
 from aiogram.types import Message
 from langchain_core.messages import HumanMessage
 
@@ -14,8 +15,8 @@ from config import CONFIG
 from transcriber import Transcriber
 
 
-# Maximum video file size in bytes
-MAX_VIDEO_SIZE = 50 * 1024 * 1024  # 50 MB
+# Maximum video file size in bytes, the upload limit of the Whisper API
+MAX_VIDEO_SIZE = 25 * 1024 * 1024  # 25 MB
 
 
 class TelegramMessageHandler:
@@ -26,7 +27,11 @@ class TelegramMessageHandler:
 
     def __init__(self, workflow_controller: WorkflowController):
         self.workflow_controller = workflow_controller
-        self.transcriber = Transcriber(CONFIG.OPENAI_API_KEY)
+        self.transcriber = Transcriber(
+            CONFIG.OPENAI_API_KEY,
+            CONFIG.TRANSCRIPTION_MODEL,
+            http_client=workflow_controller.http_async_client
+        )
 
 
     async def route_incoming_message(self, telegram_message: Message, bot):
@@ -39,7 +44,8 @@ class TelegramMessageHandler:
         chat_id = str(telegram_message.chat.id)
         user_name = telegram_message.from_user.full_name or "User"
         logger.info(
-            f"route_incoming_message: Received message in chat {chat_id} from {user_name}, type={telegram_message.content_type}"
+            "route_incoming_message: Received message in chat %s from %s, type=%s",
+            chat_id, user_name, telegram_message.content_type
         )
 
         conversation_thread_config = {"configurable": {"thread_id": chat_id}}
@@ -48,7 +54,7 @@ class TelegramMessageHandler:
         # --- Handle text messages ---
         if telegram_message.content_type == "text":
             input_text = f"{user_name}: {telegram_message.text}"
-            output = self._handle_text_message(input_text, conversation_thread_config)
+            output = await self._handle_text_message(input_text, conversation_thread_config)
             if output and output["messages"][-1].type == "ai":
                 response = output["messages"][-1].content
             else:
@@ -62,11 +68,14 @@ class TelegramMessageHandler:
             if transcription:
                 input_message_text = f"Голосовое сообщение от {telegram_message.from_user.full_name}: {transcription}"
 
-                # post the transcription as a text message to the chat
-                await telegram_message.reply(input_message_text)
+                # post the transcription as a text message to the chat, concurrently with the workflow run
+                reply_task = asyncio.create_task(telegram_message.reply(input_message_text))
 
                 # process the transcription as a text message to store it in the workflow and generate a response
-                output = self._handle_text_message(input_message_text, conversation_thread_config)
+                output = await self._handle_text_message(input_message_text, conversation_thread_config)
+
+                # make sure the transcription is posted before the bot's answer
+                await reply_task
                 if output and output["messages"][-1].type == "ai":
                     response = output["messages"][-1].content
                 else:
@@ -82,7 +91,7 @@ class TelegramMessageHandler:
         # --- Handle photos or documents ---
         elif telegram_message.content_type in ["photo", "document"]:
             # decide whether to reply on the message with image according to the common logic
-            if not self.workflow_controller.bot_should_respond(telegram_message.caption):
+            if not await self.workflow_controller.abot_should_respond(telegram_message.caption):
                 logger.info("_handle_image_or_document_message: Bot should not respond.")
                 return 
 
@@ -90,19 +99,19 @@ class TelegramMessageHandler:
 
         # --- Send the response or default apology ---
         if response:
-            logger.info(f"route_incoming_message: Sending response to user: {response[:70]}...")
+            logger.info("route_incoming_message: Sending response to user: %s...", response[:70])
             await telegram_message.reply(response)
         else:
             logger.info("route_incoming_message: No response formed.")
 #            await telegram_message.reply("Извините, я не могу обработать ваш запрос сейчас.")
 
-    def _handle_text_message(self, input_text: str, conversation_thread_config: dict) -> dict:
+    async def _handle_text_message(self, input_text: str, conversation_thread_config: dict) -> dict:
         """
         Passes the text message through WorkflowController.
         Returns the graph output (a dict) if any.
         """
         input_message = HumanMessage(input_text)
-        output = self.workflow_controller.invoke_flow(
+        output = await self.workflow_controller.ainvoke_flow(
             {"messages": input_message}, 
             conversation_thread_config
         )
@@ -123,26 +132,21 @@ class TelegramMessageHandler:
             return None
         
         file_info = await bot.get_file(file_id)
-        voice_path = f"temp_{file_id}.ogg"
 
-        await bot.download_file(file_info.file_path, voice_path)
-        logger.info(f"_handle_voice_message: File downloaded to {voice_path}")
+        # Download straight into memory, no temporary file is needed
+        voice_buffer = io.BytesIO()
+        await bot.download_file(file_info.file_path, destination=voice_buffer)
+        logger.info("_handle_voice_message: File downloaded, %s bytes", voice_buffer.getbuffer().nbytes)
 
-        transcription = self.transcriber.transcribe(voice_path)
-        logger.info(f"_handle_voice_message: Transcription: {transcription}")
-
-        # Remove the temporary file
-        try:
-            os.remove(voice_path)
-            logger.info(f"_handle_voice_message: Removed temporary file {voice_path}")
-        except Exception as e:
-            logger.error(f"Error removing temporary file {voice_path}: {str(e)}")
+        async with self.workflow_controller.api_semaphore:
+            transcription = await self.transcriber.transcribe(voice_buffer, "voice.ogg")
+        logger.info("_handle_voice_message: Transcription: %s", transcription)
 
         return transcription
 
     async def _handle_image_or_document_message(self, telegram_message: Message, user_name: str, bot) -> str:
         """
-        Downloads an image or document, encodes it in Base64, and sends it to the LLM.
+        Downloads an image or document into memory, encodes it in Base64, and sends it to the LLM.
         :return: The LLM response or an empty string if no file ID.
         """
 
@@ -157,36 +161,33 @@ class TelegramMessageHandler:
             return ""
 
         file_info = await bot.get_file(file_id)
-        image_path = f"temp_{file_id}.jpg"
 
-        await bot.download_file(file_info.file_path, image_path)
-        logger.info(f"_handle_image_or_document_message: File downloaded to {image_path}")
+        # Download straight into memory, no temporary file is needed
+        image_buffer = io.BytesIO()
+        await bot.download_file(file_info.file_path, destination=image_buffer)
+        logger.info("_handle_image_or_document_message: File downloaded, %s bytes", image_buffer.getbuffer().nbytes)
+
+        # Encoding is CPU-bound work, keep it off the event loop.
+        # pybase64 uses SIMD and reads the downloaded buffer without copying it.
+        encoded_image = await asyncio.to_thread(pybase64.b64encode, image_buffer.getbuffer())
+        # Build the data URL on bytes, so the large Base64 payload is decoded to str only once
+        image_url = (b"data:image/jpeg;base64," + encoded_image).decode("ascii")
 
-        response_text = None
-        with open(image_path, "rb") as f:
-            image_data = base64.b64encode(f.read()).decode()
-            output = self.workflow_controller.llmMain.invoke(
+        async with self.workflow_controller.api_semaphore:
+            output = await self.workflow_controller.llmMain.ainvoke(
                 [
                     (
                         "human",
                         [
                             {"type": "text", "text": f"{user_name}: {telegram_message.caption or ''}"},
-                            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data}"}}
+                            {"type": "image_url", "image_url": {"url": image_url}}
                         ],
                     ),
                     ("system", self.workflow_controller.SYSTEM_PROMPT),
+                    ("system", self.workflow_controller.TIME_PROMPT),
                 ]
             )
-            response_text = output.content
-
-        # Remove the temporary file
-        try:
-            os.remove(image_path)
-            logger.info(f"_handle_image_or_document_message: Removed temporary file {image_path}")
-        except Exception as e:
-            logger.error(f"Error removing temporary file {image_path}: {str(e)}")
-
-        return response_text
+        return output.content
 
     async def _handle_video_message(self, telegram_message: Message, bot, conversation_thread_config: dict) -> str:
         """
@@ -205,37 +206,31 @@ class TelegramMessageHandler:
         try:
             file_info = await bot.get_file(file_id)
         except Exception as e:
-            logger.error(f"_handle_video_message: Failed to get file info for video {file_id}: {e}")
+            logger.error("_handle_video_message: Failed to get file info for video %s: %s", file_id, e)
             return None
         if file_info.file_size > MAX_VIDEO_SIZE:
-            logger.error(f"_handle_video_message: Video file is too large: {file_info.file_size} bytes.")
+            logger.error("_handle_video_message: Video file is too large: %s bytes.", file_info.file_size)
             return None
 
-        video_path = f"temp_{file_id}.mp4"
-
-        await bot.download_file(file_info.file_path, video_path)
-        logger.info(f"_handle_video_message: File downloaded to {video_path}")
+        # Download straight into memory, no temporary file is needed
+        video_buffer = io.BytesIO()
+        await bot.download_file(file_info.file_path, destination=video_buffer)
+        logger.info("_handle_video_message: File downloaded, %s bytes", video_buffer.getbuffer().nbytes)
 
         try:
-            transcription = self.transcriber.transcribe_video(video_path)
+            async with self.workflow_controller.api_semaphore:
+                transcription = await self.transcriber.transcribe_video(video_buffer, "video.mp4")
         except Exception as e:
-            logger.error(f"_handle_video_message: Error during transcription: {e}")
+            logger.error("_handle_video_message: Error during transcription: %s", e)
             transcription = None
 
-        logger.info(f"_handle_video_message: Transcription: {transcription}")
-
-        # Remove the temporary file
-        try:
-            os.remove(video_path)
-            logger.info(f"_handle_video_message: Removed temporary file {video_path}")
-        except Exception as e:
-            logger.error(f"Error removing temporary file {video_path}: {str(e)}")
+        logger.info("_handle_video_message: Transcription: %s", transcription)
 
         # insert the transcription into the workflow but specify that no answer should be generated
         input_message_text = f"Видеосообщение от {telegram_message.from_user.full_name}. Транскрипция звука: {transcription or 'отсутствует'}, аннотация пользователя: {telegram_message.caption or 'отсутствует'}"
 
         input_message = HumanMessage(input_message_text, additional_kwargs={"no_answer": True})
-        self.workflow_controller.invoke_flow(
+        await self.workflow_controller.ainvoke_flow(
             {"messages": input_message}, 
             conversation_thread_config
         )
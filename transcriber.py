@@ -1,39 +1,38 @@
-import os
-import moviepy
-from openai import OpenAI
+import re
+from openai import AsyncOpenAI
 import logging
 
 logger = logging.getLogger(__name__)
 
+# In MP4 files every track declares its type in a 'hdlr' box, 'soun' is an audio track
+_MP4_AUDIO_HANDLER_RE = re.compile(rb"hdlr.{8}soun", re.DOTALL)
+
 class Transcriber:
-    def __init__(self, api_key):
-        self.client = OpenAI(api_key=api_key)
+    def __init__(self, api_key, model, http_client=None):
+        self.client = AsyncOpenAI(api_key=api_key, http_client=http_client)
+        self.model = model
 
-    def transcribe(self, file_path):
-        with open(file_path, "rb") as audio_file:
-            transcription = self.client.audio.transcriptions.create(
-                model="whisper-1", 
-                file=audio_file, 
-                response_format="text"
-            )
+    async def transcribe(self, audio_file, file_name):
+        """Transcribe an in-memory audio file. The file name tells the API the audio format."""
+        transcription = await self.client.audio.transcriptions.create(
+            model=self.model, 
+            file=(file_name, audio_file), 
+            response_format="text"
+        )
         return transcription
 
-    def transcribe_video(self, video_path, temp_audio_path="temp_audio.ogg"):
-        """Extract audio from a video, then transcribe it via Whisper."""
-        transcription_text = None
-        try:
-            clip = moviepy.VideoFileClip(video_path)
-        except Exception as e:
-            logger.error(f"transcribe_video: Failed to open video file {video_path}: {e}")
+    async def transcribe_video(self, video_file, file_name):
+        """Transcribe an in-memory video, the API accepts mp4/webm containers directly."""
+        if not self._has_audio_track(video_file):
+            logger.info("transcribe_video: %s has no audio track, skipping transcription", file_name)
             return None
-        try:
-            if clip.audio is None:
-                return None
-            clip.audio.write_audiofile(temp_audio_path, codec="libvorbis", logger=None)
-            transcription_text = self.transcribe(temp_audio_path)
-        finally:
-            if 'clip' in locals():
-                clip.close()
-            if os.path.exists(temp_audio_path):
-                os.remove(temp_audio_path)
-        return transcription_text
\ No newline at end of file
+        return await self.transcribe(video_file, file_name)
+
+    @staticmethod
+    def _has_audio_track(video_file):
+        """Cheap container check: False only for MP4 files that declare no audio track."""
+        with video_file.getbuffer() as data:
+            if data[4:8] != b"ftyp":
+                # not an MP4 file, leave it to the API
+                return True
+            return _MP4_AUDIO_HANDLER_RE.search(data) is not None
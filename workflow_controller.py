@@ -3,19 +3,55 @@ Encapsulates LangGraph logic: creates a StateGraph, registers nodes,
 and provides a method to run (invoke) the flow with incoming messages.
 """
 
+import asyncio
+import collections
 import datetime
+import functools
+import hashlib
+import itertools
 import random
+import re
 import sqlite3
+import threading
+import time
 
+import httpx
+from openai import DefaultAsyncHttpxClient, DefaultHttpxClient
 from langgraph.graph import StateGraph, START, END, MessagesState
 from langgraph.checkpoint.sqlite import SqliteSaver
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage, RemoveMessage, ToolMessage, AIMessage, HumanMessage
+from langchain_core.runnables import Runnable
 from langchain_community.tools import TavilySearchResults
 from langgraph.prebuilt import ToolNode
 
 from logger_setup import logger
 from config import ConfigManager
+from gate_cache import GateCache
+
+
+# Number of locks that serialize the runs of the same chat, chats with the same lock wait for each other
+THREAD_LOCK_STRIPES = 64
+
+# Maximum number of should-respond decisions kept in the cache
+GATE_CACHE_SIZE = 4096
+
+# Messages repeated in the same chat within this window are not answered again
+DUPLICATE_WINDOW_SECONDS = 10 * 60
+# Maximum number of recent messages remembered by the duplicate filter
+DUPLICATE_FILTER_SIZE = 8192
+
+# Words that count as a mention of the bot, in addition to its @username
+MENTION_KEYWORDS = ("петрович", "бот", "bot")
+
+
+@functools.lru_cache(maxsize=None)
+def _mention_pattern(bot_username: str) -> re.Pattern:
+    """
+    Compiles (once per username) a case-insensitive regex matching any mention keyword.
+    """
+    keywords = MENTION_KEYWORDS + (f"@{bot_username}",)
+    return re.compile("|".join(re.escape(keyword) for keyword in keywords), re.IGNORECASE)
 
 
 class WorkflowController:
@@ -25,11 +61,48 @@ class WorkflowController:
 
     def __init__(self, config: ConfigManager):
         self.config = config
-        conn = sqlite3.connect("main_workflow_memory.sqlite", check_same_thread=False)
+        db_path = "main_workflow_memory.sqlite"
+        conn = sqlite3.connect(db_path, check_same_thread=False)
+        # WAL lets reads proceed during checkpoint writes; with WAL, synchronous=NORMAL only
+        # syncs at WAL checkpoints instead of on every commit and is still corruption-safe
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-20000")  # ~20 MB page cache
         self.memory = SqliteSaver(conn)
-
-        # Prepare the system prompt with current date and time
-        date_and_time = datetime.datetime.now().strftime("%d.%m.%Y %H:%M")
+        # A fixed table of locks shared by hash of the thread id, so that it does not grow with every new chat
+        self._thread_locks = [asyncio.Lock() for _ in range(THREAD_LOCK_STRIPES)]
+
+        # The bot's Telegram username, set by the application once it is known
+        self.bot_username = None
+
+        # Own random generator for the random responses, not shared with the module-level one
+        self._rng = random.Random()
+        # RANDOM_RESPONSE_PROBABILITY scaled to the 16 random bits compared against it
+        self._random_response_threshold = int(self.config.RANDOM_RESPONSE_PROBABILITY * 65536)
+
+        # Recently seen (chat, content) hashes with the time they were seen, oldest first
+        self._recent_messages = collections.deque()
+        self._recent_message_keys = set()
+        self._recent_messages_lock = threading.Lock()
+
+        # Caps the OpenAI work in flight at once (graph runs, gate checks, image and transcription
+        # requests) to respect the API rate limits
+        self.api_semaphore = asyncio.Semaphore(self.config.MAX_CONCURRENT_OPENAI)
+
+        # LRU cache of should-respond probabilities, keyed by a hash of the analyzed messages
+        # and kept in the same database, so that it survives restarts
+        self._gate_cache = GateCache(db_path, GATE_CACHE_SIZE)
+
+        # Connection pools shared by all OpenAI clients (LLMs and the transcriber), so that
+        # TLS connections to the API are reused across them and kept alive between messages
+        http_limits = httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60)
+        self.http_client = DefaultHttpxClient(limits=http_limits)
+        self.http_async_client = DefaultAsyncHttpxClient(limits=http_limits)
+
+        # The system prompts are static so that OpenAI's prompt caching can reuse them as a prefix.
+        # The current date and time is passed separately, see TIME_PROMPT.
         self.SYSTEM_PROMPT = (
             "Вы — ПетровичAI, приятный и ненавязчивый бот. Вы общаетесь на русском языке, "
             "если только вас прямо не попросят отвечать на другом языке. "
@@ -38,7 +111,6 @@ class WorkflowController:
             "Вместе с этим системным сообщением вам передаются последние сообщения из диалога."
             "Среди них есть транскрипции голосовых сообщений, которые вы можете использовать для ответа. "
             "Используйте инструмент TavilySearchResults для поиска информации в интернете. "
-            f"Сейчас {date_and_time}."
         )
 
         self.SYSTEM_PROMPT_SHOULD_RESPOND = self.SYSTEM_PROMPT + (
@@ -64,27 +136,68 @@ class WorkflowController:
             "Далее приведена история сообщений. "
         )
 
-        # Initialize tools and LLM
+        # The static prompts are wrapped into messages once, they are never modified by the LLM calls
+        self._system_message = SystemMessage(self.SYSTEM_PROMPT)
+        self._should_respond_system_message = SystemMessage(self.SYSTEM_PROMPT_SHOULD_RESPOND)
+
+        # Digest of what else decides the gate answer, mixed into the decision cache keys so that
+        # a different gate model or prompt does not reuse the probabilities cached for the old one
+        self._gate_cache_prefix = hashlib.blake2b(
+            f"{self.config.SHOULD_RESPOND_MODEL}\0{self.SYSTEM_PROMPT_SHOULD_RESPOND}".encode(), digest_size=16
+        ).digest()
+
+        # Rendered TIME_PROMPT and the minute it was rendered for
+        self._time_prompt = None
+        self._time_prompt_minute = None
+
+        # Initialize tools
         search_tool = TavilySearchResults(
             max_results=3,
             include_answer=True,
             include_raw_content=False
         )
-        tools = [search_tool]
+        self._tools = [search_tool]
 
-        self.llmMain = ChatOpenAI(
+        # Build the graph. LLM clients are created lazily on first use.
+        self.graph = self._build_graph(self._tools)
+        logger.info("WorkflowController: Initialization complete.")
+
+    @functools.cached_property
+    def llmMain(self) -> Runnable:
+        """
+        Main LLM with the tools bound, created on first use.
+        """
+        return ChatOpenAI(
             model=self.config.MAIN_WORKFLOW_MODEL,
-            api_key=self.config.OPENAI_API_KEY
-        ).bind_tools(tools)
+            api_key=self.config.OPENAI_API_KEY,
+            http_client=self.http_client,
+            http_async_client=self.http_async_client
+        ).bind_tools(self._tools)
 
-        self.llmShouldReply = ChatOpenAI(
+    @functools.cached_property
+    def llmShouldReply(self) -> ChatOpenAI:
+        """
+        LLM deciding whether the bot should respond, created on first use.
+        """
+        return ChatOpenAI(
             model=self.config.SHOULD_RESPOND_MODEL,
-            api_key=self.config.OPENAI_API_KEY
+            api_key=self.config.OPENAI_API_KEY,
+            http_client=self.http_client,
+            http_async_client=self.http_async_client
         )
 
-        # Build the graph
-        self.graph = self._build_graph(tools)
-        logger.info("WorkflowController: Initialization complete.")
+    @property
+    def TIME_PROMPT(self) -> str:
+        """
+        System prompt with the current date and time.
+        It only shows minutes, so it is re-rendered at most once a minute.
+        """
+        minute = int(time.time() // 60)
+        if minute != self._time_prompt_minute:
+            date_and_time = datetime.datetime.now().strftime("%d.%m.%Y %H:%M")
+            self._time_prompt = f"Сейчас {date_and_time}."
+            self._time_prompt_minute = minute
+        return self._time_prompt
 
     def _build_graph(self, tools) -> StateGraph:
         """
@@ -100,25 +213,14 @@ class WorkflowController:
         workflow.add_node("node_truncate_message_history_phase2", self._node_truncate_message_history_phase2)
 
         # Define edges
-        workflow.add_conditional_edges(START, self._bot_should_respond_router, ["node_llm_query", "node_truncate_message_history_phase1"])
+        # The decision whether to respond is made in invoke_flow, the graph only runs when the bot responds
+        workflow.add_edge(START, "node_llm_query")
         workflow.add_conditional_edges("node_llm_query", self._tool_router, ["tools", "node_truncate_message_history_phase1"])
         workflow.add_edge("tools", "node_llm_query")
         workflow.add_edge("node_truncate_message_history_phase1", "node_truncate_message_history_phase2")
 
         return workflow.compile(checkpointer=self.memory)
 
-    def _bot_should_respond_router(self, state: MessagesState) -> str:
-        """
-        Checks if the bot should respond to the last message.
-        """
-        from petrovichai import BOT_USERNAME
-        last_message = state["messages"][-1]
-
-        should_respond = self._bot_should_respond(state, BOT_USERNAME)
-
-        logger.info(f"_bot_should_respond_router: last_message='{last_message.content}', respond={should_respond}")
-        return "node_llm_query" if should_respond else "node_truncate_message_history_phase1"
-
     def _tool_router(self, state: MessagesState) -> str:
         """
         If the LLM wants to call a tool, go to the ToolNode; otherwise, truncate the message history.
@@ -137,12 +239,18 @@ class WorkflowController:
         """
         messages = state["messages"]
 
-        # Append system prompt if not already present
-        if not any(isinstance(msg, SystemMessage) and msg.content == self.SYSTEM_PROMPT for msg in messages):
-            messages.append(SystemMessage(self.SYSTEM_PROMPT))
+        # Send at most MESSAGE_HISTORY_LIMIT messages, the stored history is truncated only
+        # at the end of the run. A tool result can't open the window without its tool call.
+        start = max(0, len(messages) - self.config.MESSAGE_HISTORY_LIMIT)
+        while start < len(messages) and isinstance(messages[start], ToolMessage):
+            start += 1
+
+        # The system prompts are added to the LLM input only and never stored in the state.
+        # The date and time goes last, so that it does not break the cached prompt prefix.
+        llm_input = [self._system_message] + messages[start:] + [SystemMessage(self.TIME_PROMPT)]
 
-        response = self.llmMain.invoke(messages)
-        logger.info(f"_node_llm_query: LLM response: '{response.content}'")
+        response = self.llmMain.invoke(llm_input)
+        logger.info("_node_llm_query: LLM response: '%s'", response.content)
         return {"messages": [response]}
 
     def _node_truncate_message_history_phase1(self, state: MessagesState) -> dict:
@@ -150,14 +258,11 @@ class WorkflowController:
         Removes all tool and system messages from the state.
         """
 
-        # delete all tool and system messages from the state
-        deleted_tool_messages = [RemoveMessage(id=m.id) for m in state["messages"] if isinstance(m, ToolMessage)]
-        deleted_system_messages = [RemoveMessage(id=m.id) for m in state["messages"] if isinstance(m, SystemMessage)]
-        
-        #delete assistant messages with tool calls
-        deleted_toolcalls_messages = [RemoveMessage(id=m.id) for m in state["messages"] if isinstance(m, AIMessage) and m.tool_calls]
-
-        deleted_messages = deleted_tool_messages + deleted_system_messages + deleted_toolcalls_messages
+        # delete all tool and system messages and assistant messages with tool calls, in a single pass
+        deleted_messages = [
+            RemoveMessage(id=m.id) for m in state["messages"]
+            if isinstance(m, (ToolMessage, SystemMessage)) or (isinstance(m, AIMessage) and m.tool_calls)
+        ]
 
         return {"messages": deleted_messages}
 
@@ -165,8 +270,9 @@ class WorkflowController:
         """
         Keeps only the last MESSAGE_HISTORY_LIMIT messages.
         """
-        msgs_to_keep = self.config.MESSAGE_HISTORY_LIMIT
-        deleted_messages = [RemoveMessage(id=m.id) for m in state["messages"][:-msgs_to_keep]]
+        messages = state["messages"]
+        excess = len(messages) - self.config.MESSAGE_HISTORY_LIMIT
+        deleted_messages = [RemoveMessage(id=m.id) for m in itertools.islice(messages, excess)] if excess > 0 else []
 
         return {"messages": deleted_messages}
 
@@ -179,11 +285,7 @@ class WorkflowController:
         """
         if not message:
             return False
-        lower_text = message.lower()
-        return any(
-            keyword in lower_text
-            for keyword in ["петрович", "бот", "bot", f"@{bot_username}"]
-        )
+        return _mention_pattern(bot_username).search(message) is not None
     
     def _bot_should_respond(self, state: MessagesState, bot_username: str) -> bool:
         """
@@ -191,6 +293,7 @@ class WorkflowController:
         """
 
         HISTORY_LENGTH_TO_ANALYZE = 6
+        MESSAGE_LENGTH_TO_ANALYZE = 400
 
         last_message = state["messages"][-1].content
 
@@ -205,7 +308,7 @@ class WorkflowController:
             return False
 
         # First make simple checks like random probability
-        if random.random() < self.config.RANDOM_RESPONSE_PROBABILITY:
+        if self._rng.getrandbits(16) < self._random_response_threshold:
             return True
         
         # Check if the LLM thinks the bot should respond
@@ -214,21 +317,39 @@ class WorkflowController:
         # Remove system messages from the history
         messages = [msg for msg in message_history if not isinstance(msg, SystemMessage)]
 
-        # Add specific system prompt to analyse if LLM should respond on the last message
-        # adding it twice make the results better \_(o.o)_/
-        messages = [SystemMessage(self.SYSTEM_PROMPT_SHOULD_RESPOND)] + messages + [SystemMessage(self.SYSTEM_PROMPT_SHOULD_RESPOND)]
-
-        #invoke LLM. Answer should be a float.
-        response = self.llmShouldReply.invoke(messages)
-
-        #translate response to float
-        try:
-            reply_probability = float(response.content)
-        except ValueError:
-            logger.error(f"Invalid response from LLM: {response.content}")
-            return False
-
-        logger.info(f"_bot_should_respond: LLM response: {reply_probability}, while threshold is {self.config.LLM_DECISSION_TO_RESPOND_THRESHOLD}")
+        # The gist of each message is enough for the decision, cut long ones to save input tokens
+        messages = [
+            msg.model_copy(update={"content": msg.content[:MESSAGE_LENGTH_TO_ANALYZE] + "…"})
+            if isinstance(msg.content, str) and len(msg.content) > MESSAGE_LENGTH_TO_ANALYZE else msg
+            for msg in messages
+        ]
+
+        # The same conversation window always gets the same answer, reuse it if it was already classified
+        cache_key = hashlib.blake2b(
+            self._gate_cache_prefix + "\0".join(f"{msg.type}:{msg.content}" for msg in messages).encode(),
+            digest_size=16
+        ).digest()
+        reply_probability = self._gate_cache.get(cache_key)
+
+        if reply_probability is None:
+            # Add specific system prompt to analyse if LLM should respond on the last message
+            # adding it twice make the results better \_(o.o)_/
+            messages = [self._should_respond_system_message] + messages + [self._should_respond_system_message]
+
+            #invoke LLM. Answer should be a float.
+            response = self.llmShouldReply.invoke(messages)
+
+            #translate response to float
+            try:
+                reply_probability = float(response.content)
+            except ValueError:
+                logger.error("Invalid response from LLM: %s", response.content)
+                return False
+
+            # Store the probability rather than the decision, so the threshold can change without invalidation
+            self._gate_cache.put(cache_key, reply_probability)
+
+        logger.info("_bot_should_respond: LLM response: %s, while threshold is %s", reply_probability, self.config.LLM_DECISSION_TO_RESPOND_THRESHOLD)
         return reply_probability > self.config.LLM_DECISSION_TO_RESPOND_THRESHOLD
 
     
@@ -236,19 +357,110 @@ class WorkflowController:
         """
         Public method to check if the bot should respond to the message.
         """
-        from petrovichai import BOT_USERNAME
-
         if not message:
             logger.error("bot_should_respond: Empty message.")
             return False
 
         # convert the string message into a state for further processing
         messages_state = MessagesState(messages=[HumanMessage(content=message)])
-        return self._bot_should_respond(messages_state, BOT_USERNAME)        
+        return self._bot_should_respond(messages_state, self.bot_username)        
+
+    async def abot_should_respond(self, message: str) -> bool:
+        """
+        Async counterpart of bot_should_respond, the LLM call runs in a worker thread.
+        """
+        async with self.api_semaphore:
+            return await asyncio.to_thread(self.bot_should_respond, message)
     
     def invoke_flow(self, messages_dict: dict, thread_config: dict) -> dict:
         """
         Public method to pass messages into the graph. 
-        Returns the result (a dict containing new messages).
+        Decides first whether the bot should respond: if not, the messages are only
+        appended to the stored history and no graph run is made.
+        Returns the result (a dict containing new messages), or None if the bot does not respond.
+        """
+        new_messages = messages_dict["messages"]
+        if not isinstance(new_messages, list):
+            new_messages = [new_messages]
+
+        history = self.graph.get_state(thread_config).values.get("messages", [])
+        message_key = self._message_key(thread_config["configurable"]["thread_id"], new_messages[-1].content)
+        is_duplicate = self._is_duplicate(message_key)
+        should_respond = (
+            not is_duplicate
+            and self._bot_should_respond(MessagesState(messages=history + new_messages), self.bot_username)
+        )
+        logger.info("invoke_flow: last_message='%s', respond=%s", new_messages[-1].content, should_respond)
+
+        if not should_respond:
+            self._append_to_history(history, new_messages, thread_config)
+            result = None
+        else:
+            result = self.graph.invoke(messages_dict, thread_config)
+
+        # Remember the message only once it was handled, so that a retry after an API error is not dropped
+        if not is_duplicate:
+            self._remember_message(message_key)
+        return result
+
+    @staticmethod
+    def _message_key(thread_id: str, content) -> bytes:
+        """
+        Hash of the message content within its chat, used by the duplicate filter.
+        """
+        return hashlib.blake2b(f"{thread_id}\0{content}".encode(), digest_size=8).digest()
+
+    def _is_duplicate(self, message_key: bytes) -> bool:
+        """
+        Checks whether the same message was already handled in the chat within DUPLICATE_WINDOW_SECONDS.
+        """
+        now = time.monotonic()
+
+        with self._recent_messages_lock:
+            # forget the messages that fell out of the window
+            while self._recent_messages and now - self._recent_messages[0][0] > DUPLICATE_WINDOW_SECONDS:
+                self._recent_message_keys.discard(self._recent_messages.popleft()[1])
+
+            if message_key in self._recent_message_keys:
+                logger.info("_is_duplicate: Message already seen in this chat.")
+                return True
+            return False
+
+    def _remember_message(self, message_key: bytes):
+        """
+        Adds a handled message to the duplicate filter, dropping the oldest ones over DUPLICATE_FILTER_SIZE.
+        """
+        with self._recent_messages_lock:
+            if message_key in self._recent_message_keys:
+                return
+            while len(self._recent_messages) >= DUPLICATE_FILTER_SIZE:
+                self._recent_message_keys.discard(self._recent_messages.popleft()[1])
+
+            self._recent_messages.append((time.monotonic(), message_key))
+            self._recent_message_keys.add(message_key)
+
+    def _append_to_history(self, history: list, new_messages: list, thread_config: dict):
+        """
+        Writes messages straight into the thread's checkpoint without executing any nodes,
+        keeping only the last MESSAGE_HISTORY_LIMIT messages.
+        """
+        excess = len(history) + len(new_messages) - self.config.MESSAGE_HISTORY_LIMIT
+        deleted_messages = [RemoveMessage(id=m.id) for m in itertools.islice(history, excess)] if excess > 0 else []
+
+        self.graph.update_state(
+            thread_config,
+            {"messages": deleted_messages + new_messages},
+            as_node="node_truncate_message_history_phase2"
+        )
+
+    async def ainvoke_flow(self, messages_dict: dict, thread_config: dict) -> dict:
+        """
+        Async counterpart of invoke_flow that does not block the event loop.
+        SqliteSaver only supports synchronous access, so the graph runs in a worker thread.
         """
-        return self.graph.invoke(messages_dict, thread_config)
+        # Runs of the same chat must not interleave, otherwise one would overwrite the other's checkpoint
+        # The chat lock is taken first, so that waiting runs of a busy chat don't hold API slots
+        thread_id = thread_config["configurable"]["thread_id"]
+        async with self._thread_locks[hash(thread_id) % THREAD_LOCK_STRIPES]:
+            async with self.api_semaphore:
+                return await asyncio.to_thread(self.invoke_flow, messages_dict, thread_config)